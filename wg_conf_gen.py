@@ -1,9 +1,12 @@
 import argparse
 import logging
 import os
+import shutil
 import subprocess
 import sys
+import tempfile
 import json
+from concurrent.futures import ThreadPoolExecutor
 
 
 def check_wg_exists():
@@ -26,6 +29,38 @@ def gen_key_pair() -> (str, str, str):
     psk = psk_output.decode("utf-8").strip()
     return (key, pubkey, psk)
 
+
+def write_file(path, content, fsync=True):
+    """write content to path atomically, via a temporary file and a rename"""
+    # write next to the real file so a symlinked path keeps pointing at it
+    path = os.path.realpath(path)
+    # mkstemp creates a uniquely named 0600 file with O_EXCL, so concurrent
+    # writers never share it and a planted symlink is never followed
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path), prefix=os.path.basename(path) + "."
+    )
+    try:
+        with os.fdopen(fd, "w") as f:
+            # the content may hold private keys, give the temporary file the
+            # owner and permissions of the file it replaces before writing
+            if os.path.exists(path):
+                path_stat = os.stat(path)
+                try:
+                    os.fchown(f.fileno(), path_stat.st_uid, path_stat.st_gid)
+                except PermissionError:
+                    pass
+                shutil.copymode(path, tmp_path)
+            f.write(content)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
 def gen_example(path):
     with open(path, "w") as f:
         f.write("""
@@ -56,10 +91,32 @@ def gen_example(path):
     """)
 
 
-# def gen_server_config(configs):
-#     pass
-#
-#
+def gen_server_config(configs) -> str:
+    """render the server config, with one [Peer] section per client"""
+    server = configs["server"]
+    common = configs["common"]
+    server_interface = server["interface"]
+    network_name = common["network_name"]
+    interface_section = f"""[Interface]
+Address = {server["vlan_ipv4_addr"]}/24
+ListenPort = {server["port"]}
+PrivateKey = {server["prvkey"]}
+PostUp = iptables -A FORWARD -i {server_interface} -o {network_name} -j ACCEPT; iptables -A FORWARD -i {network_name} -j ACCEPT; iptables -t nat -A POSTROUTING -o {server_interface} -j MASQUERADE
+PostDown = iptables -D FORWARD -i {server_interface} -o {network_name} -j ACCEPT; iptables -D FORWARD -i {network_name} -j ACCEPT; iptables -t nat -D POSTROUTING -o {server_interface} -j MASQUERADE
+    """
+    peer_sections = "".join(
+        f"""
+### Client {client["name"]}
+[Peer]
+PublicKey = {client["pubkey"]}
+PresharedKey = {client["psk"]}
+AllowedIPs = {client["vlan_ipv4_addr"]}/32
+"""
+        for client in configs["clients"]
+    )
+    return interface_section + peer_sections
+
+
 # def gen_client_config(configs):
 #     pass
 
@@ -77,6 +134,7 @@ if __name__ == "__main__":
     arg_parser.add_argument("-o", "--output", type=str, default=".", help="the path to output directory")
     arg_parser.add_argument("--gen-example", action="store_true", default=False, help="flag to enable generate example")
     arg_parser.add_argument("--gen-example-path", type=str, default="config.example.json", help="output a example json configuration file")
+    arg_parser.add_argument("--no-fsync", dest="fsync", action="store_false", default=True, help="skip fsync after writing each file, faster but less durable")
 
     args = arg_parser.parse_args()
 
@@ -84,24 +142,22 @@ if __name__ == "__main__":
         gen_example(args.gen_example_path)
         sys.exit(0)
 
-    logging.info(f"loading configuration file {args.config}")
+    logging.info("loading configuration file %s", args.config)
     configs = json.load(open(args.config))
 # print(configs)
 
 # keys = {}
     logging.debug("generate keys for server and clients")
-    if "prvkey" not in configs["server"].keys():
-        server_key_pair = gen_key_pair()
-        configs["server"]["prvkey"] = server_key_pair[0]
-        configs["server"]["pubkey"] = server_key_pair[1]
-        configs["server"]["psk"] = server_key_pair[2]
-
-    for client in configs["clients"]:
-        if "prvkey" not in client.keys():
-            client_key_pair = gen_key_pair()
-            client["prvkey"] = client_key_pair[0]
-            client["pubkey"] = client_key_pair[1]
-            client["psk"] = client_key_pair[2]
+    nodes_without_keys = [
+        node
+        for node in [configs["server"]] + configs["clients"]
+        if "prvkey" not in node.keys()
+    ]
+    # every key pair costs three `wg` subprocesses, run them for all nodes at once
+    with ThreadPoolExecutor() as executor:
+        key_pairs = [executor.submit(gen_key_pair) for _ in nodes_without_keys]
+        for node, key_pair in zip(nodes_without_keys, key_pairs):
+            node["prvkey"], node["pubkey"], node["psk"] = key_pair.result()
 
 # print(configs)
 
@@ -112,32 +168,11 @@ if __name__ == "__main__":
     )
     server_config_path = os.path.join(os.path.abspath(args.output), server_config_name)
 
-    with open(server_config_path, "w") as f:
-        server = configs["server"]
-        common = configs["common"]
-        server_interface = server["interface"]
-        network_name = common["network_name"]
-        f.write(
-        f"""[Interface]
-Address = {server["vlan_ipv4_addr"]}/24
-ListenPort = {server["port"]}
-PrivateKey = {server["prvkey"]}
-PostUp = iptables -A FORWARD -i {server_interface} -o {network_name} -j ACCEPT; iptables -A FORWARD -i {network_name} -j ACCEPT; iptables -t nat -A POSTROUTING -o {server_interface} -j MASQUERADE
-PostDown = iptables -D FORWARD -i {server_interface} -o {network_name} -j ACCEPT; iptables -D FORWARD -i {network_name} -j ACCEPT; iptables -t nat -D POSTROUTING -o {server_interface} -j MASQUERADE
-    """
-    )
-        for client in configs["clients"]:
-            f.write(f"""
-### Client {client["name"]}
-[Peer]
-PublicKey = {client["pubkey"]}
-PresharedKey = {client["psk"]}
-AllowedIPs = {client["vlan_ipv4_addr"]}/32
-""")
+    write_file(server_config_path, gen_server_config(configs), fsync=args.fsync)
 
 # gen client config
     for client in configs["clients"]:
-        logging.info(f'generate config fie for client {client["name"]}')
+        logging.info("generate config fie for client %s", client["name"])
         server = configs["server"]
         common = configs["common"]
         common_header = f"""[Interface]
@@ -164,8 +199,7 @@ PersistentKeepalive = 25
 """
             )
 
-            with open(config_global_path, "w") as f:
-                f.write(global_configs)
+            write_file(config_global_path, global_configs, fsync=args.fsync)
 
         if client["gen_local"]:
             config_local_name = (
@@ -179,8 +213,7 @@ PersistentKeepalive = 25
 """
             )
 
-            with open(config_local_path, "w") as f:
-                f.write(local_configs)
+            write_file(config_local_path, local_configs, fsync=args.fsync)
 
 
-    json.dump(configs, open(args.config, "w"))
+    write_file(args.config, json.dumps(configs), fsync=args.fsync)